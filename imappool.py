@@ -0,0 +1,127 @@
+"""A pool of reusable IMAP SSL connections, to save TLS handshakes when stat'ing many users."""
+
+import imaplib
+import socket
+
+class imappool:
+    def __init__(self, size=4):
+        """Initializes an imappool object, keeping up to <size> idle connections per server. Counts new connections in <handshakes>, and reused connections in <saved>."""
+        self.size = size
+        self.idle = dict()
+        self.unauth = dict()    # Whether each server supports UNAUTHENTICATE, learned on first checkin.
+        self.handshakes = 0
+        self.saved = 0
+
+
+    def checkout(self, server=None, mech=None, authobject=None):
+        """Returns an IMAP connection to <server>, authenticated using <mech> and the <authobject> callback. An idle connection is reused if there is one, otherwise a new connection is opened. If the server rejects the login, the connection is kept idle for the next user and the error is raised."""
+        idle = self.idle.setdefault(server, [])
+
+        while len(idle) > 0:
+            imap = idle.pop()
+
+            try:
+                imap.authenticate(mech, authobject)
+
+            except (imaplib.IMAP4.abort, socket.error):    # Dead connection. Try the next one.
+                self.close(imap)
+                continue
+
+            except imaplib.IMAP4.error:     # Login rejected; the connection is still good.
+                idle.append(imap)
+                raise
+
+            self.saved += 1
+            return imap
+
+        imap = imaplib.IMAP4_SSL(server)
+        self.handshakes += 1
+
+        try:
+            imap.authenticate(mech, authobject)
+
+        except (imaplib.IMAP4.abort, socket.error):
+            self.close(imap)
+            raise
+
+        except imaplib.IMAP4.error:
+            self.keep(imap)
+            raise
+
+        return imap
+
+
+    def checkin(self, imap):
+        """Returns an <imap> connection to the pool. If the pool is full, or the server can't unauthenticate the connection for reuse, it's logged out."""
+        if self.unauthenticate(imap):
+            self.keep(imap)
+
+        else:
+            self.close(imap)
+
+
+    def keep(self, imap):
+        """Keeps an unauthenticated <imap> connection idle for reuse, or logs it out if the pool is full."""
+        idle = self.idle.setdefault(imap.host, [])
+
+        if len(idle) < self.size:
+            idle.append(imap)
+
+        else:
+            self.close(imap)
+
+
+    def unauthenticate(self, imap):
+        """Sends an IMAP unauthenticate on <imap>, if the server supports it, and clears the previous user's session state. Returns True if the connection can be authenticated again, False otherwise."""
+        if imap.state not in ("AUTH", "SELECTED") or self.unauth.get(imap.host) == False:
+            return False
+
+        try:
+            if imap.host not in self.unauth:
+                capa_ret, capa_data = imap.capability()
+                self.unauth[imap.host] = (capa_ret == "OK" and "UNAUTHENTICATE" in capa_data[0].upper().split())
+
+                if self.unauth[imap.host] == False:
+                    return False
+
+            # UNAUTHENTICATE (RFC 8437) isn't in imaplib's command table, so it's sent by hand.
+            tag = imap._new_tag()
+            imap.send("%s UNAUTHENTICATE\r\n" % tag)
+            unau_ret, unau_data = imap._command_complete("UNAUTHENTICATE", tag)
+
+        except (imaplib.IMAP4.error, imaplib.IMAP4.abort, socket.error):
+            return False
+
+        if unau_ret == "OK":
+            imap.state = "NONAUTH"
+            imap.untagged_responses = {}
+            imap.is_readonly = False
+            imap.capabilities = ()
+            return True
+        else:
+            return False
+
+
+    def close(self, imap):
+        """Logs out of <imap>, ignoring errors from connections that have already gone away."""
+        try:
+            imap.logout()
+
+        except (imaplib.IMAP4.error, imaplib.IMAP4.abort, socket.error):
+            pass
+
+
+    def closeall(self):
+        """Logs out of every idle connection in the pool. Call this when done with the pool."""
+        for idle in self.idle.values():
+            while len(idle) > 0:
+                self.close(idle.pop())
+
+
+    def stats(self):
+        """Returns a dict with the number of TLS handshakes done, the number saved by reusing connections, and the number of idle connections."""
+        return {"handshakes":self.handshakes, "saved":self.saved, "idle":sum([len(idle) for idle in self.idle.values()])}
+
+
+    def __str__(self):
+        return "%(handshakes)d handshakes, %(saved)d saved by reuse, %(idle)d idle connections" % self.stats()
@@ -5,22 +5,27 @@ import base64
 from pyparsing import Word, alphas, nums, printables, ZeroOrMore, ParseException
 
 class imapstat:
-    def __init__(self, imapserver=None, imapadmin=None, imappassword=None, gmaildomain=None, gmailsecret=None):
-        """Sets parameters for the object: <imapserver>, <imapadmin>, <imappassword>, <gmaildomain> and <gmailsecret>."""
+    def __init__(self, imapserver=None, imapadmin=None, imappassword=None, gmaildomain=None, gmailsecret=None, pool=None):
+        """Sets parameters for the object: <imapserver>, <imapadmin>, <imappassword>, <gmaildomain> and <gmailsecret>. If an imappool is given as <pool>, connections are taken from and returned to it."""
         self.imapserver = imapserver
         self.imapadmin = imapadmin
         self.imappassword = imappassword
         self.gmailserver = "imap.gmail.com"
         self.gmaildomain = gmaildomain
         self.gmailsecret = gmailsecret
+        self.pool = pool
 
 
     def cyr_connect(self, user = None):
         """Establishes a cyrus connection for <user>."""
         authstring = "%s\x00%s\x00%s" % (user, self.imapadmin, self.imappassword)
 
-        self.imap = imaplib.IMAP4_SSL(self.imapserver)
-        self.imap.authenticate("PLAIN", lambda x: authstring)
+        if self.pool != None:
+            self.imap = self.pool.checkout(self.imapserver, "PLAIN", lambda x: authstring)
+
+        else:
+            self.imap = imaplib.IMAP4_SSL(self.imapserver)
+            self.imap.authenticate("PLAIN", lambda x: authstring)
 
 
     def gmail_connect(self, user = None):
@@ -31,13 +36,38 @@ class imapstat:
 
         authstring = xoauth.GenerateXOauthString(xoconsumer, xotoken, xouser, "imap", xouser, None, None)
 
-        self.imap = imaplib.IMAP4_SSL(self.gmailserver)
-        self.imap.authenticate("XOAUTH", lambda x: authstring)
+        if self.pool != None:
+            self.imap = self.pool.checkout(self.gmailserver, "XOAUTH", lambda x: authstring)
+
+        else:
+            self.imap = imaplib.IMAP4_SSL(self.gmailserver)
+            self.imap.authenticate("XOAUTH", lambda x: authstring)
 
 
     def disconnect(self):
-        """Closes an established IMAP cyr_connection."""
-        self.imap.logout()
+        """Closes an established IMAP connection, or returns it to the pool."""
+        if self.pool != None:
+            self.pool.checkin(self.imap)
+
+        else:
+            self.imap.logout()
+
+
+    def poolstats(self):
+        """Returns the pool's dict of handshakes done, handshakes saved and idle connections, or None if there's no pool."""
+        if self.pool != None:
+            return self.pool.stats()
+
+        else:
+            return None
+
+
+    def closepool(self):
+        """Logs out of the pool's idle connections, when done stat'ing users. Returns the final poolstats."""
+        if self.pool != None:
+            self.pool.closeall()
+
+        return self.poolstats()
 
 
     def mboxstat(self, mbox):
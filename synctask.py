@@ -5,8 +5,8 @@ from psuldap import psuldap
 import shlex, subprocess
 import memcache
 
-@task(ignore_result=True)
-def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserver=None, adminuser=None, plevel="test", dryrun=True, runlimit=7200, user=None):
+def synccommand(imapserver=None, adminuser=None, plevel="test", dryrun=True, runlimit=7200, user=None):
+    """Builds the imapsync command line for <user>, syncing from <imapserver> as <adminuser> to the Google domain for <plevel>. Raises an exception on a bad <plevel> or <runlimit>."""
     imapsync_dir = "/opt/google-imap/"
     imapsync_cmd = imapsync_dir + "imapsync"
     cyrus_pf = imapsync_dir + "cyrus.pf"
@@ -14,7 +14,6 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
     whitespace_cleanup = " --regextrans2 's/[ ]+/ /g' --regextrans2 's/\s+$//g' --regextrans2 's/\s+(?=\/)//g' --regextrans2 's/^\s+//g' --regextrans2 's/(?=\/)\s+//g'"
     folder_cases = " --regextrans2 's/^drafts$/[Gmail]\/Drafts/i' --regextrans2 's/^trash$/[Gmail]\/Trash/i' --regextrans2 's/^(sent|sent-mail)$/[Gmail]\/Sent Mail/i' --delete2foldersbutnot '^\[Gmail\]'"
     extra_opts = " --delete2 --delete2folders --fast"
-    exitstatus = "premature"
 
     if dryrun:
         extra_opts = extra_opts + " --dry" 
@@ -33,22 +32,22 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
     else:
         raise Exception("Plevel must be test or prod.")
 
-    command = imapsync_cmd + " --pidfile /tmp/imapsync-" + user + ".pid --host1 " + imapserver + " --port1 993 --user1 " + user + " --authuser1 " + adminuser + " --passfile1 " + cyrus_pf + " --host2 imap.gmail.com --port2 993 --user2 " + user + "@" + google_domain + " --passfile2 " + google_pf + " --ssl1 --ssl2 --maxsize 26214400 --authmech1 PLAIN --authmech2 XOAUTH -sep1 '/' --exclude " + exclude_list + folder_cases + whitespace_cleanup + extra_opts
+    return imapsync_cmd + " --pidfile /tmp/imapsync-" + user + ".pid --host1 " + imapserver + " --port1 993 --user1 " + user + " --authuser1 " + adminuser + " --passfile1 " + cyrus_pf + " --host2 imap.gmail.com --port2 993 --user2 " + user + "@" + google_domain + " --passfile2 " + google_pf + " --ssl1 --ssl2 --maxsize 26214400 --authmech1 PLAIN --authmech2 XOAUTH -sep1 '/' --exclude " + exclude_list + folder_cases + whitespace_cleanup + extra_opts
 
-    cache = memcache.Client(servers=state_memcaches)            # System state
-    nosync_cache = memcache.Client(servers=nosync_memcaches)    # Users not-to-sync
 
+def syncskip(ldapuri=None, cache=None, nosync_cache=None, user=None):
+    """Returns True if <user> should not be synced: already in the <nosync_cache>, opted in, or with a Google mailHost in the directory at <ldapuri>. Records the latter two in the <nosync_cache>."""
     cachekey = "(%s,auto)" % user
     optinkey = "email_copy_progress.%s" % user
 
     if nosync_cache.get(cachekey) != None:  # If the key exists in this cache, skip the sync.
-        return (user, "nosync")
+        return True
 
     if cache.get(optinkey) != None:         # If the user has opted in, skip the sync.
         if nosync_cache.set(cachekey,{"status":"nosync"}) != True:
             raise Exception("Could not set %s in nosync_cache." % cachekey)
 
-        return (user, "nosync")
+        return True
 
     directory = psuldap()       # Our LDAP handle
     directory.connect(ldapuri)  # Anonymous bind
@@ -63,23 +62,28 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
                 if nosync_cache.set(cachekey,{"status":"nosync"}) != True:
                     raise Exception("Could not set %s in nosync_cache." % cachekey)
 
-                return (user, "nosync")
+                return True
 
-    # We can continue.
+    return False
+
+
+def syncstart(cache=None, user=None, taskid=None, runlimit=7200):
+    """Moves <user> from queued to running under <taskid> in the state <cache>, expiring after <runlimit> plus a fudge factor. Returns the running state."""
+    cachekey = "(%s,auto)" % user
     cachestate = cache.gets(cachekey)
 
     if cachestate == None:  # Maybe the cache has been cleared. Continue.
         pass
 
     # Well, it looks like the cache has another task's data for this user. Abort.
-    elif cachestate["status"] != "queued" or cachestate["taskid"] != imapsync.request.id:
+    elif cachestate["status"] != "queued" or cachestate["taskid"] != taskid:
         raise Exception("Cache inconsistency error for user %s." % user)
 
     # We're good to go. Let's set the cache with our new state.
     runstate = {
         "status":"running"
         ,"timestamp":int(time())
-        ,"taskid":imapsync.request.id
+        ,"taskid":taskid
         ,"worker":uname()[1]
     }
 
@@ -88,7 +92,12 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
     if cache.cas(cachekey, runstate, time=cachelimit) != True: # Whoops, something changed. Abort.
         raise Exception("Cache inconsistency error for user %s." % user)
 
-    syncprocess = subprocess.Popen(
+    return runstate
+
+
+def syncspawn(command=None):
+    """Starts the imapsync <command>, discarding its output. Returns the subprocess."""
+    return subprocess.Popen(
         args=shlex.split(command)
         ,bufsize=-1
         ,close_fds=True
@@ -96,26 +105,28 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
         ,stderr=None
     )
 
-    starttime = time()
 
-    # While the process is running, and we're under the time limit
-    while (syncprocess.poll() == None) and ((time() - starttime) < runlimit):
-        sleep(5)
-    
-    # Are we still running? Send a SIGTERM to the process and throw the task back on the queue.
-    # This is done to prevent one user from tying up a worker for longer than the runlimit.
-    if (syncprocess.poll() == None):
+def syncreap(syncprocess=None, starttime=None, runlimit=7200):
+    """Checks on a running <syncprocess> without blocking. Returns None while it is running under the <runlimit>, otherwise its exit status: ok, error_<returncode>, or outtatime if it had to be terminated."""
+    if syncprocess.poll() == None:
+        if (time() - starttime) < runlimit:
+            return None
+
+        # Still running? Send a SIGTERM to the process.
+        # This is done to prevent one user from tying up a worker for longer than the runlimit.
         syncprocess.terminate()     # Send SIGTERM
         syncprocess.communicate()   # Read stdin/out, and wait for process to terminate
-        exitstatus = "outtatime"
+        return "outtatime"
 
-    else:
-        if syncprocess.returncode == 0:
-            exitstatus = "ok"
+    if syncprocess.returncode == 0:
+        return "ok"
+
+    return "error_%d" % syncprocess.returncode
 
-        else:
-            exitstatus = "error_%d" % syncprocess.returncode
 
+def syncfinish(cache=None, user=None, taskid=None, runstate=None, starttime=None, exitstatus=None):
+    """Moves <user> from <runstate> to complete under <taskid> in the state <cache>, recording the <exitstatus> and the runtime since <starttime>."""
+    cachekey = "(%s,auto)" % user
     cachestate = cache.gets(cachekey)
 
     if cachestate == None: # Maybe the cache has been cleared. Continue.
@@ -129,7 +140,7 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
     endstate = {
         "status":"complete"
         ,"timestamp":int(time())
-        ,"taskid":imapsync.request.id
+        ,"taskid":taskid
         ,"worker":uname()[1]
         ,"returned":exitstatus
         ,"runtime":int(time() - starttime)
@@ -138,4 +149,30 @@ def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserv
     if cache.cas(cachekey, endstate) != True: # Whoops, something changed. Abort.
         raise Exception("Cache inconsistency error for user %s." % user)
 
+
+@task(ignore_result=True)
+def imapsync(ldapuri=None, state_memcaches=None, nosync_memcaches=None, imapserver=None, adminuser=None, plevel="test", dryrun=True, runlimit=7200, user=None):
+    command = synccommand(imapserver=imapserver, adminuser=adminuser, plevel=plevel, dryrun=dryrun, runlimit=runlimit, user=user)
+
+    cache = memcache.Client(servers=state_memcaches)            # System state
+    nosync_cache = memcache.Client(servers=nosync_memcaches)    # Users not-to-sync
+
+    if syncskip(ldapuri=ldapuri, cache=cache, nosync_cache=nosync_cache, user=user):
+        return (user, "nosync")
+
+    # We can continue.
+    runstate = syncstart(cache=cache, user=user, taskid=imapsync.request.id, runlimit=runlimit)
+    syncprocess = syncspawn(command)
+    starttime = time()
+
+    # While the process is running, and we're under the time limit. Past the limit,
+    # the process is terminated and the task is thrown back on the queue.
+    exitstatus = syncreap(syncprocess, starttime, runlimit)
+
+    while exitstatus == None:
+        sleep(5)
+        exitstatus = syncreap(syncprocess, starttime, runlimit)
+
+    syncfinish(cache=cache, user=user, taskid=imapsync.request.id, runstate=runstate, starttime=starttime, exitstatus=exitstatus)
+
     return (user, exitstatus)
@@ -1,8 +1,11 @@
-from synctask import imapsync
+from synctask import imapsync, synccommand, syncskip, syncstart, syncspawn, syncreap, syncfinish
 from psuldap import psuldap
 from googledata import domaininfo
 from getpass import getpass
 from time import sleep, time
+from collections import deque
+from multiprocessing import cpu_count
+from uuid import uuid4
 import memcache
 
 class usersync:
@@ -60,10 +63,8 @@ class usersync:
         print("Ready to launch!")
 
 
-    def launchuser(self, user=None):
-        """Submits a asynchronous task for a given user, first checking memcache to see if there are extent tasks--if there are, it returns None. If clear, it returns the task id of the queued task."""
-        nosync_cache = memcache.Client(servers=self.nosync_memcaches)   # Users not-to-sync
-        cache = memcache.Client(servers=self.state_memcaches)           # System state
+    def launchcheck(self, cache=None, nosync_cache=None, user=None):
+        """Checks the state <cache> and <nosync_cache> to see if a sync may be launched for <user>. Returns a dict with "proceed" set to a boolean, and a "reason" if it may not."""
         cachekey = "(%s,auto)" % user
         optinkey = "email_copy_progress.%s" % user
 
@@ -73,7 +74,9 @@ class usersync:
             optinstate = cache.gets(optinkey)
 
         except:
-            return {"submitted":False,"reason":"cache fetch error"}
+            return {"proceed":False,"reason":"cache fetch error"}
+
+        reason = None
 
         if nosyncstate != None or optinstate != None:   # If the key exists in this cache, skip the sync.
             proceed = False
@@ -89,7 +92,18 @@ class usersync:
             proceed = False
             reason = userstate["status"]
 
-        if proceed:
+        return {"proceed":proceed,"reason":reason}
+
+
+    def launchuser(self, user=None):
+        """Submits a asynchronous task for a given user, first checking memcache to see if there are extent tasks--if there are, it returns None. If clear, it returns the task id of the queued task."""
+        nosync_cache = memcache.Client(servers=self.nosync_memcaches)   # Users not-to-sync
+        cache = memcache.Client(servers=self.state_memcaches)           # System state
+        cachekey = "(%s,auto)" % user
+
+        launchstate = self.launchcheck(cache=cache, nosync_cache=nosync_cache, user=user)
+
+        if launchstate["proceed"]:
             try:
                 task = imapsync.delay(
                     ldapuri=self.ldapuri
@@ -116,11 +130,144 @@ class usersync:
                 return {"submitted":False,"reason":"cache cas error"}
 
         else:
-            return {"submitted":False,"reason":reason}
+            return {"submitted":False,"reason":launchstate["reason"]}
+
+
+    def launchlocal(self, cache=None, nosync_cache=None, user=None):
+        """Starts an imapsync process for <user> on this host, taking it through the same queued and running states as the imapsync task. Returns a dict with "started" set to a boolean, and either a "reason" or the running sync's "taskid", "runstate", "process" and "starttime"."""
+        cachekey = "(%s,auto)" % user
+
+        launchstate = self.launchcheck(cache=cache, nosync_cache=nosync_cache, user=user)
+
+        if launchstate["proceed"] != True:
+            return {"started":False,"reason":launchstate["reason"]}
+
+        command = synccommand(imapserver=self.imapserver, adminuser=self.adminuser, plevel=self.plevel, dryrun=self.dryrun, runlimit=self.runlimit, user=user)
+
+        taskid = "local-%s" % uuid4()
+        cachedata = {"status":"queued", "timestamp":int(time()), "taskid":taskid}
+
+        if cache.cas(cachekey, cachedata, time=86400) != True:
+            return {"started":False,"reason":"cache cas error"}
+
+        if syncskip(ldapuri=self.ldapuri, cache=cache, nosync_cache=nosync_cache, user=user):
+            return {"started":False,"reason":"nosync"}
+
+        runstate = syncstart(cache=cache, user=user, taskid=taskid, runlimit=self.runlimit)
+
+        return {"started":True, "user":user, "taskid":taskid, "runstate":runstate, "process":syncspawn(command), "starttime":time()}
+
+
+    def runlocal(self, users=None, concurrency=None, interval=5):
+        """Runs synchronization for an externally provided list of users on this host, without Celery--a drop-in for launchlist. Up to <concurrency> imapsync processes, by default one per CPU, are supervised at once and polled every <interval> seconds. A process over the runlimit is sent a SIGTERM, and a SIGKILL if it's still running at the next poll. If the run is interrupted, any running processes are killed the same way. Returns a list of (user, status) tuples, as returned by the imapsync task."""
+        if concurrency == None:
+            concurrency = cpu_count()
+
+        if concurrency <= 0:
+            raise Exception("Concurrency must be a positive integer.")
+
+        # Check plevel and runlimit before any user is touched.
+        synccommand(imapserver=self.imapserver, adminuser=self.adminuser, plevel=self.plevel, dryrun=self.dryrun, runlimit=self.runlimit, user="")
+
+        nosync_cache = memcache.Client(servers=self.nosync_memcaches)   # Users not-to-sync
+        cache = memcache.Client(servers=self.state_memcaches)           # System state
+
+        pending = deque(users)
+        running = []
+        runstat = []
+
+        try:
+            while pending or running:
+                # Fill any free slots.
+                while pending and len(running) < concurrency:
+                    user = pending.popleft()
+
+                    try:
+                        sync = self.launchlocal(cache=cache, nosync_cache=nosync_cache, user=user)
+
+                    except Exception as e:  # One user's trouble shouldn't stop the rest of the list.
+                        print("user %s : %s" % (user, e))
+                        runstat.append((user, "exception"))
+                        continue
+
+                    if sync["started"] == True:
+                        print("user %s : started as %s" % (user, sync["taskid"]))
+                        running.append(sync)
+
+                    else:
+                        print("user %s : %s" % (user, sync["reason"]))
+                        runstat.append((user, sync["reason"]))
+
+                if running:
+                    sleep(interval)
+
+                # Reap finished processes, and terminate any that are over the runlimit.
+                stillrunning = []
+
+                for sync in running:
+                    syncprocess = sync["process"]
+
+                    if syncprocess.poll() == None:
+                        if "termtime" in sync:    # Ignored our SIGTERM for a whole interval? Send a SIGKILL.
+                            syncprocess.kill()
+
+                        elif (time() - sync["starttime"]) >= self.runlimit:
+                            syncprocess.terminate()     # Reaped on a later pass; waiting here would hold up every other sync.
+                            sync["termtime"] = time()
+
+                        stillrunning.append(sync)
+                        continue
+
+                    if "termtime" in sync:
+                        sync["exitstatus"] = "outtatime"
+
+                    else:
+                        sync["exitstatus"] = syncreap(syncprocess, sync["starttime"], self.runlimit)
+
+                    try:
+                        syncfinish(cache=cache, user=sync["user"], taskid=sync["taskid"], runstate=sync["runstate"], starttime=sync["starttime"], exitstatus=sync["exitstatus"])
+
+                    except Exception as e:
+                        print("user %s : %s" % (sync["user"], e))
+                        runstat.append((sync["user"], "exception"))
+                        continue
+
+                    print("user %s : %s" % (sync["user"], sync["exitstatus"]))
+                    runstat.append((sync["user"], sync["exitstatus"]))
+
+                running = stillrunning
+
+        finally:
+            # Interrupted? Don't leave orphaned imapsyncs running with no runlimit.
+            unfinished = [sync for sync in running if "exitstatus" not in sync]
+
+            for sync in unfinished:
+                if sync["process"].poll() == None:
+                    sync["process"].terminate()
+
+            if [sync for sync in unfinished if sync["process"].poll() == None]:
+                sleep(5)
+
+            for sync in unfinished:
+                if sync["process"].poll() == None:
+                    sync["process"].kill()
+
+                sync["process"].wait()
+
+                try:
+                    syncfinish(cache=cache, user=sync["user"], taskid=sync["taskid"], runstate=sync["runstate"], starttime=sync["starttime"], exitstatus="outtatime")
+
+                except Exception as e:
+                    print("user %s : %s" % (sync["user"], e))
+                    continue
+
+                print("user %s : outtatime" % sync["user"])
+
+        return runstat
 
 
     def launchlist(self, users=None, interval=0.5):
-        """Launches synchronization for an externally provided list of users. Interval is the time between submissions."""
+        """Launches synchronization for an externally provided list of users. Interval is the time between submissions. To run the syncs on this host without Celery, use runlocal instead."""
         submitstat = []
 
         for user in users: